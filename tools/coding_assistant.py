@@ -17,6 +17,7 @@
 
 
 import argparse
+import io
 import os
 import platform
 import subprocess
@@ -25,10 +26,6 @@ import tempfile
 import time
 from pathlib import Path
 
-import openai
-from bs4 import BeautifulSoup
-from bs4.element import PageElement, Tag
-
 
 MODELS: list[str] = [
     "qwen3.6:27b-q4_K_M-160k",
@@ -45,6 +42,13 @@ MODELS: list[str] = [
     "gpt-oss:20b-128k",
 ]
 
+# Maps every prefix of every model name to the first model in MODELS that it matches
+MODELS_BY_PREFIX: dict[str, str] = {model[:i]: model for model in reversed(MODELS) for i in range(len(model) + 1)}
+
+# The HTML files opened in the browser are left in the temp directory, so later runs clean them up
+HTML_FILE_PREFIX: str = "coding_assistant-"
+HTML_FILE_MAX_AGE: int = 5 * 60
+
 LANGUAGE_EXPERTISE: list[str] = [
     "Python",
     "Java",
@@ -59,28 +63,40 @@ SKILLS: list[str] = [
 ]
 
 
+class CoalescingPrinter:
+    """Collects streamed text and writes it to stdout in batches instead of once per token."""
+
+    def __init__(self, max_delay: float = 0.02, max_size: int = 256) -> None:
+        self.max_delay: float = max_delay
+        self.max_size: int = max_size
+        self.pending: list[str] = []
+        self.pending_size: int = 0
+        self.last_flush: float = time.monotonic()
+
+    def print(self, text: str) -> None:
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.max_size or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        sys.stdout.write("".join(self.pending))
+        sys.stdout.flush()
+        self.pending.clear()
+        self.pending_size = 0
+        self.last_flush = time.monotonic()
+
+
 def find_model_by_prefix(prefix: str) -> str:
-    for model in MODELS:
-        if model.startswith(prefix):
-            return model
+    model: str | None = MODELS_BY_PREFIX.get(prefix)
+    if model is not None:
+        return model
     raise ValueError(f"Model with prefix \"{prefix}\" not found. Available models are: {", ".join(MODELS)}")
 
 def format_duration(seconds: float | int) -> str:
-    seconds = int(seconds)
-    if seconds < 60:
-        return f"{seconds}s"
-    elif seconds < 3600:
-        minutes, remaining_seconds = divmod(seconds, 60)
-        return f"{minutes}m{remaining_seconds}s" if remaining_seconds > 0 else f"{minutes}m"
-    else:
-        hours, remaining = divmod(seconds, 3600)
-        minutes, seconds = divmod(remaining, 60)
-        parts: list[str] = [
-            f"{hours}h" if hours > 0 else "",
-            f"{minutes}m" if minutes > 0 or not hours else "",
-            f"{seconds}s" if seconds > 0 or not minutes and not hours else "",
-        ]
-        return "".join(parts)
+    hours, remaining = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remaining, 60)
+    return "".join(f"{value}{unit}" for value, unit in ((hours, "h"), (minutes, "m"), (seconds, "s")) if value) or "0s"
 
 def join_with_and(strs: list[str]) -> str:
     if len(strs) == 0:
@@ -94,8 +110,32 @@ def join_with_and(strs: list[str]) -> str:
         last_string: str = strs[-1]
         return f"{all_but_last}, and {last_string}"
 
+NO_PREAMBLE_INSTRUCTION: str = "Do NOT prefix your responses with any words like \"Certainly!\", \"Sure!\", or similar phrases."
+
+CODING_SYSTEM_MESSAGE: str = "\n".join([
+    "You are Koda, an AI coding assistant.",
+    f"You are an expert in {join_with_and(LANGUAGE_EXPERTISE)}.",
+    f"You are also an expert at {join_with_and(SKILLS)}.",
+    NO_PREAMBLE_INSTRUCTION,
+    "If your answer contains fenced code blocks in Markdown, include the relevant full file path in the code block tag using this structure: ```$LANGUAGE:$FILEPATH```",
+    "For example, for a Python file \"program.py\", the structure should be: ```python:program.py```",
+    "For executable terminal commands, enclose each command in an individual ```bash``` language fenced code block without any comments or newlines inside.",
+])
+
+GENERALIST_SYSTEM_MESSAGE: str = "\n".join([
+    "You are Koda, an AI assistant.",
+    NO_PREAMBLE_INSTRUCTION,
+])
+
 def replace_think_tag(html_data: bytes, thinking_html: bytes, thinking_time: float) -> bytes:
-    soup: BeautifulSoup = BeautifulSoup(html_data.decode("utf-8"), "html.parser")
+    if b"<think" not in html_data:
+        return html_data
+
+    from bs4 import BeautifulSoup, SoupStrainer
+    from bs4.element import PageElement, Tag
+
+    # Only build the <think> element, since that is the only part of the document we modify
+    soup: BeautifulSoup = BeautifulSoup(html_data, "lxml", from_encoding="utf-8", parse_only=SoupStrainer("think"))
 
     think: PageElement | None = soup.find("think")
     if think is None or not isinstance(think, Tag):
@@ -107,13 +147,25 @@ def replace_think_tag(html_data: bytes, thinking_html: bytes, thinking_time: flo
     summary.string = "💡 Thought Process (thought for {})".format(format_duration(thinking_time))
     details.append(summary)
 
+    # lxml wraps fragments in <html><body>, so only move over the body's children
+    thinking_soup: BeautifulSoup = BeautifulSoup(thinking_html, "lxml", from_encoding="utf-8")
+    thinking_root: Tag = thinking_soup.body or thinking_soup
+
     div: Tag = soup.new_tag("div")
-    div.append(BeautifulSoup(thinking_html.decode("utf-8"), "html.parser"))
+    div.extend(list(thinking_root.contents))
     details.append(div)
 
-    think.replace_with(details)
+    return html_data.replace(think.encode("utf-8"), details.encode("utf-8"), 1)
 
-    return str(soup).encode("utf-8")
+def remove_old_html_files() -> None:
+    """Delete HTML files from earlier runs that the browser has had plenty of time to load."""
+    now: float = time.time()
+    for path in Path(tempfile.gettempdir()).glob(HTML_FILE_PREFIX + "*.html"):
+        try:
+            if now - path.stat().st_mtime > HTML_FILE_MAX_AGE:
+                path.unlink()
+        except FileNotFoundError:
+            pass
 
 def parse_args() -> argparse.Namespace:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Coding Assistant.", formatter_class=argparse.RawTextHelpFormatter)
@@ -136,6 +188,10 @@ def parse_args() -> argparse.Namespace:
 def main() -> None:
     args: argparse.Namespace = parse_args()
 
+    remove_old_html_files()
+
+    import openai
+
     # Read from environment variables if not provided via command-line arguments
     api_key: str = args.api_key or os.getenv("OPENAI_API_KEY") or "dummy"
     base_url: str | None = args.base_url or os.getenv("OPENAI_BASE_URL")
@@ -148,29 +204,7 @@ def main() -> None:
         base_url=base_url,
     )
 
-    system_message_parts: list[str] = [
-        "You are Koda, an AI coding assistant.",
-        f"You are an expert in {join_with_and(LANGUAGE_EXPERTISE)}.",
-        f"You are also an expert at {join_with_and(SKILLS)}.",
-    ]
-
-    if args.generalist:
-        system_message_parts = [
-            "You are Koda, an AI assistant.",
-        ]
-
-    system_message_parts.extend([
-        "Do NOT prefix your responses with any words like \"Certainly!\", \"Sure!\", or similar phrases.",
-    ])
-
-    if not args.generalist:
-        system_message_parts.extend([
-            "If your answer contains fenced code blocks in Markdown, include the relevant full file path in the code block tag using this structure: ```$LANGUAGE:$FILEPATH```",
-            "For example, for a Python file \"program.py\", the structure should be: ```python:program.py```",
-            "For executable terminal commands, enclose each command in an individual ```bash``` language fenced code block without any comments or newlines inside.",
-        ])
-
-    system_message: str = "\n".join(system_message_parts)
+    system_message: str = GENERALIST_SYSTEM_MESSAGE if args.generalist else CODING_SYSTEM_MESSAGE
 
     messages: list[dict[str, str]] = [
         {
@@ -207,7 +241,7 @@ def main() -> None:
 
     messages.append({"role": "user", "content": final_prompt})
 
-    start_time: float = time.time()
+    start_time: int = time.monotonic_ns()
 
     response: openai.Stream[openai.types.chat.ChatCompletionChunk] = client.chat.completions.create(
         model=args.model,
@@ -219,16 +253,22 @@ def main() -> None:
 
     print(f"Model: {args.model}", file=sys.stderr)
 
-    response_start: float | None = None
-    think_start: float | None = None
-    think_end: float | None = None
+    response_start: int | None = None
+    think_start: int | None = None
+    think_end: int | None = None
 
     think_start_idx: int | None = None
     think_end_idx: int | None = None
 
     usage: openai.types.chat.chat_completion.CompletionUsage | None = None
-    collected_response: str = ""
-    collected_reasoning: str = ""
+    collected_chunks: list[str] = []
+    collected_length: int = 0
+    reasoning_chunks: list[str] = []
+
+    # The end of the previous chunk, so tags split across chunks can still be found
+    tag_tail: str = ""
+
+    printer: CoalescingPrinter = CoalescingPrinter()
     for chunk in response:
         if not chunk:
             break
@@ -242,56 +282,78 @@ def main() -> None:
 
             if reasoning_content or chunk_content:
                 if response_start is None:
-                    response_start = time.time()
+                    response_start = time.monotonic_ns()
 
             if reasoning_content:
                 if think_start is None:
-                    think_start = time.time()
-                    print("<think>", flush=True)
+                    think_start = time.monotonic_ns()
+                    printer.print("<think>\n")
 
-                print(reasoning_content, end="", flush=True)
-                collected_reasoning += reasoning_content
+                printer.print(reasoning_content)
+                reasoning_chunks.append(reasoning_content)
 
             elif chunk_content is not None:
-                if collected_reasoning and think_end is None:
-                    think_end = time.time()
-                    print("\n<think>\n", flush=True)
-
-                if "<think>" in chunk_content and think_start is None:
-                    think_start = time.time()
-                    think_start_idx = len(collected_response) + chunk_content.index("<think>")
-
-                if "</think>" in chunk_content and think_end is None:
-                    think_end = time.time()
-                    think_end_idx = len(collected_response) + chunk_content.index("</think>")
-
-                print(chunk_content, end="", flush=True)
-                collected_response += chunk_content
+                if reasoning_chunks and think_end is None:
+                    think_end = time.monotonic_ns()
+                    printer.print("\n<think>\n\n")
+
+                if think_end is None:
+                    window: str = tag_tail + chunk_content
+                    window_start: int = collected_length - len(tag_tail)
+
+                    if think_start is None:
+                        open_idx: int = window.find("<think>")
+                        if open_idx >= 0:
+                            think_start = time.monotonic_ns()
+                            think_start_idx = window_start + open_idx
+
+                    close_idx: int = window.find("</think>")
+                    if close_idx >= 0:
+                        think_end = time.monotonic_ns()
+                        think_end_idx = window_start + close_idx
+
+                    tag_tail = window[-(len("</think>") - 1):]
+
+                printer.print(chunk_content)
+                collected_chunks.append(chunk_content)
+                collected_length += len(chunk_content)
+    printer.flush()
     print()
 
-    end_time: float = time.time()
+    end_time: int = time.monotonic_ns()
+
+    collected_response: str = "".join(collected_chunks)
+    collected_reasoning: str = "".join(reasoning_chunks)
 
     if response_start is None:
         response_start = end_time
 
     thinking_time: float = 0
     if think_start is not None and think_end is not None:
-        thinking_time = think_end - think_start
+        thinking_time = (think_end - think_start) / 1e9
 
     if usage:
-        pp_time: float = response_start - start_time
-        gen_time: float = end_time - response_start
-        total_time: float = end_time - start_time
+        pp_time: float = (response_start - start_time) / 1e9
+        gen_time: float = (end_time - response_start) / 1e9
+        total_time: float = (end_time - start_time) / 1e9
+
+        total_tokens: int = usage.total_tokens
+        prompt_tokens: int = usage.prompt_tokens
+        completion_tokens: int = usage.completion_tokens
+
+        # Either phase can take no measurable time, e.g. when the prompt is served from the cache
+        pp_speed: float = prompt_tokens / pp_time if pp_time > 1e-6 else 0.0
+        gen_speed: float = completion_tokens / gen_time if gen_time > 1e-6 else 0.0
 
         token_usage_message: str = "\n".join([
             "",
-            "Tokens used: {}".format(usage.total_tokens),  # type: ignore[union-attr]
-            "Prompt tokens: {}".format(usage.prompt_tokens),  # type: ignore[union-attr]
-            "Completion tokens: {}".format(usage.completion_tokens),  # type: ignore[union-attr]
-            "Total time taken: {:.6f} seconds".format(total_time),
-            "Time spent thinking: {:.6f} seconds".format(thinking_time),
-            "Prompt processing speed: {:.2f} tokens/s".format(usage.prompt_tokens / pp_time),  # type: ignore[union-attr]
-            "Generation speed: {:.2f} tokens/s".format(usage.completion_tokens / gen_time),  # type: ignore[union-attr]
+            f"Tokens used: {total_tokens}",
+            f"Prompt tokens: {prompt_tokens}",
+            f"Completion tokens: {completion_tokens}",
+            f"Total time taken: {total_time:.6f} seconds",
+            f"Time spent thinking: {thinking_time:.6f} seconds",
+            f"Prompt processing speed: {pp_speed:.2f} tokens/s",
+            f"Generation speed: {gen_speed:.2f} tokens/s",
         ])
 
         print(token_usage_message, file=sys.stderr)
@@ -299,93 +361,94 @@ def main() -> None:
     if args.no_browser:
         return
 
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".md") as markdown_file:
-        markdown_paragraphs: list[str] = [
-            "**Model:** `{}`".format(args.model),
-            "## Prompt",
+    # Extract thinking from response, if any
+    thinking: str | None = None
+    response_parts: list[str] = [collected_response]
+    if think_start_idx is not None and think_end_idx is not None:
+        before_think: str = collected_response[:think_start_idx]
+        thinking = collected_response[think_start_idx + len("<think>"):think_end_idx]
+        after_think: str = collected_response[think_end_idx + len("</think>"):]
+        response_parts = [before_think, "<think></think>\n\n", after_think]
+    elif collected_reasoning:
+        thinking = collected_reasoning
+        response_parts = ["<think></think>\n\n", collected_response]
+
+    script_directory: Path = Path(__file__).resolve().parent
+    css_path: Path = script_directory / "resources" / "gh-pandoc.css"
+    copy_script_html_path: Path = script_directory / "resources" / "copy.html"
+    filter_path: Path = script_directory / "support" / "filter_wrapper.sh"
+
+    pandoc_args: list[str] = [
+        "pandoc",
+        "--embed-resources",
+        "--standalone",
+        "--css", str(css_path),
+    ]
+
+    if (script_directory / "support" / ".env" / "bin" / "python3").is_file():
+        pandoc_args.extend([
+            "--include-in-header", str(copy_script_html_path),
+            "--filter", str(filter_path),
+        ])
+
+    pandoc_args.extend([
+        "--highlight-style", "kate",
+        "--metadata", "title=Coding Assistant",
+        "-f", "gfm",
+        "-t", "html",
+    ])
+
+    # Feed the markdown to pandoc over stdin so it can get to work while the thinking is formatted
+    pandoc: subprocess.Popen = subprocess.Popen(pandoc_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    assert pandoc.stdin is not None
+    with io.TextIOWrapper(pandoc.stdin, encoding="utf-8") as markdown_file:
+        markdown_file.writelines([
+            "**Model:** `{}`\n\n".format(args.model),
+            "## Prompt\n\n",
             args.user_prompt,
-        ]
+            "\n\n",
+        ])
 
         if args.filenames:
-            markdown_paragraphs.append("**Context:**")
-            markdown_paragraphs.append("\n".join(["- `{}`".format(filename) for filename in args.filenames]))
-
-        markdown_paragraphs.append("## Response")
-
-        # Extract and format thinking from response, if any
-        thinking_html: bytes | None = None
-        thinking: str | None = None
-        if think_start_idx is not None and think_end_idx is not None:
-            before_think: str = collected_response[:think_start_idx]
-            thinking = collected_response[think_start_idx + len("<think>"):think_end_idx]
-            after_think: str = collected_response[think_end_idx + len("</think>"):]
-            collected_response = f"{before_think}<think></think>\n\n{after_think}"
-        elif collected_reasoning:
-            thinking = collected_reasoning
-            collected_response = f"<think></think>\n\n{collected_response}"
-
-        if thinking is not None:
-            complete: subprocess.CompletedProcess = subprocess.run([
-                "pandoc",
-                "--highlight-style", "kate",
-                "-f", "gfm",
-                "-t", "html",
-            ], input=thinking.encode("utf-8"), stdout=subprocess.PIPE)
-
-            if complete.returncode != 0:
-                raise Exception("Failed to format thinking!")
-
-            thinking_html = complete.stdout
-
-        markdown_paragraphs.append(collected_response)
-
-        markdown_file.write("\n\n".join(markdown_paragraphs))
-        markdown_file.flush()
-
-        with tempfile.NamedTemporaryFile(mode="wb", suffix=".html") as html_file:
-            script_directory: Path = Path(__file__).resolve().parent
-            css_path: Path = script_directory / "resources" / "gh-pandoc.css"
-            copy_script_html_path: Path = script_directory / "resources" / "copy.html"
-            filter_path: Path = script_directory / "support" / "filter_wrapper.sh"
-
-            pandoc_args: list[str] = [
-                "pandoc",
-                "--embed-resources",
-                "--standalone",
-                "--css", str(css_path),
-            ]
-
-            if (script_directory / "support" / ".env" / "bin" / "python3").is_file():
-                pandoc_args.extend([
-                    "--include-in-header", str(copy_script_html_path),
-                    "--filter", str(filter_path),
-                ])
-
-            pandoc_args.extend([
-                "--highlight-style", "kate",
-                "--metadata", "title=Coding Assistant",
-                "-f", "gfm",
-                "-t", "html",
-                markdown_file.name,
-            ])
-
-            output: subprocess.CompletedProcess = subprocess.run(
-                pandoc_args, stdout=subprocess.PIPE)
-
-            if output.returncode == 0:
-                html_data: bytes = output.stdout
-                if thinking_html is not None:
-                    html_data = replace_think_tag(html_data, thinking_html, thinking_time)
-                html_file.write(html_data)
-                html_file.flush()
-
-                if platform.system() == "Darwin":
-                    subprocess.run(["open", html_file.name])
-                else:
-                    subprocess.run(["chromium", "--incognito", html_file.name])
-
-                time.sleep(3)
+            markdown_file.write("**Context:**\n\n")
+            markdown_file.writelines(["- `{}`\n".format(filename) for filename in args.filenames])
+            markdown_file.write("\n")
+
+        markdown_file.write("## Response\n\n")
+        markdown_file.writelines(response_parts)
+
+    # Format thinking, if any
+    thinking_html: bytes | None = None
+    if thinking is not None:
+        complete: subprocess.CompletedProcess = subprocess.run([
+            "pandoc",
+            "--highlight-style", "kate",
+            "-f", "gfm",
+            "-t", "html",
+        ], input=thinking.encode("utf-8"), stdout=subprocess.PIPE)
+
+        if complete.returncode != 0:
+            raise Exception("Failed to format thinking!")
+
+        thinking_html = complete.stdout
+
+    assert pandoc.stdout is not None
+    html_data: bytes = pandoc.stdout.read()
+    if pandoc.wait() != 0:
+        return
+
+    if thinking_html is not None:
+        html_data = replace_think_tag(html_data, thinking_html, thinking_time)
 
+    # Leave the HTML file in place so the browser can load it after we exit. A later run deletes it.
+    with tempfile.NamedTemporaryFile(mode="wb", prefix=HTML_FILE_PREFIX, suffix=".html", delete=False) as html_file:
+        html_file.write(html_data)
+
+    if platform.system() == "Darwin":
+        subprocess.run(["open", html_file.name])
+    else:
+        subprocess.run(["chromium", "--incognito", html_file.name])
 
 if __name__ == "__main__":
     main()
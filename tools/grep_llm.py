@@ -16,13 +16,19 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 
+from __future__ import annotations
+
 import argparse
+import asyncio
 import os
 import sys
-import json
-from typing import NamedTuple
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+import orjson
 
-import openai
+if TYPE_CHECKING:
+    import openai
 
 
 MODELS: list[str] = [
@@ -30,25 +36,26 @@ MODELS: list[str] = [
     # "granite3.1-dense:8b-instruct-q4_K_M-128k",
 ]
 
+# Maps every prefix of every model name to the first model in MODELS that it matches
+MODELS_BY_PREFIX: dict[str, str] = {model[:i]: model for model in reversed(MODELS) for i in range(len(model) + 1)}
+
 
 class Error(NamedTuple):
     message: str
 
 
-def is_text_file(filepath: str) -> bool:
-    try:
-        with open(filepath, "tr", encoding="utf-8"):
-            pass
-        return True
-    except UnicodeDecodeError:
-        return False
-
 def find_model_by_prefix(prefix: str) -> str:
-    for model in MODELS:
-        if model.startswith(prefix):
-            return model
+    model: str | None = MODELS_BY_PREFIX.get(prefix)
+    if model is not None:
+        return model
     raise ValueError(f"Model with prefix \"{prefix}\" not found. Available models are: {", ".join(MODELS)}")
 
+def positive_int(value: str) -> int:
+    number: int = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def parse_args() -> argparse.Namespace:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Check files against a specified prompt using an LLM.", formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("-k", "--api-key", type=str,
@@ -58,70 +65,80 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("-m", "--model", type=find_model_by_prefix, default=MODELS[0],
                         help="Model to use. You can provide a prefix match for any of the following models (default: {}):\n\n{} ".format(
                             MODELS[0], "\n".join(["- {}".format(model) for model in MODELS])))
+    parser.add_argument("-j", "--jobs", type=positive_int, default=4,
+                        help="Number of files to check concurrently (default: 4)")
     parser.add_argument("prompt", type=str,
                         help="The prompt to check against each file's content")
 
     return parser.parse_args()
 
-def process_file(filepath: str, client: openai.OpenAI, system_message: str, args: argparse.Namespace) -> str | Error | None:
-    if not is_text_file(filepath):
-        return None
-
-    contents: str = open(filepath, "r", encoding="utf-8").read().strip()
-
-    user_message: str = f"Content for \"{filepath}\":\n\n```\n{contents}\n```\n"
-
-    messages: list[dict[str, str]] = [
-        {
-            "role": "user",
-            "content": user_message,
-        },
-        {
-            "role": "assistant",
-            "content": "Ok.",
-        },
-        {
-            "role": "system",
-            "content": system_message,
-        },
-    ]
-
-    response: openai.types.chat.ChatCompletion | openai.Stream[openai.types.chat.ChatCompletionChunk] = client.chat.completions.create(
-        model=args.model,
-        messages=messages,  # type: ignore[arg-type]
-        stream=True,
-    )
+async def process_file(filepath: str, client: openai.AsyncOpenAI, semaphore: asyncio.Semaphore, system_message: str, args: argparse.Namespace) -> str | Error | None:
+    import openai
+
+    # Read the file under the semaphore too, so only the files actually being checked are held in memory
+    async with semaphore:
+        try:
+            contents: str = Path(filepath).read_bytes().decode("utf-8").strip()
+        except UnicodeDecodeError:
+            return None
+
+        user_message: str = f"Content for \"{filepath}\":\n\n```\n{contents}\n```\n"
+
+        # Keep the system message first so the server can reuse its cached prefix across files
+        messages: list[dict[str, str]] = [
+            {
+                "role": "system",
+                "content": system_message,
+            },
+            {
+                "role": "user",
+                "content": user_message,
+            },
+        ]
+
+        response: openai.types.chat.ChatCompletion | openai.AsyncStream[openai.types.chat.ChatCompletionChunk] = await client.chat.completions.create(
+            model=args.model,
+            messages=messages,  # type: ignore[arg-type]
+            stream=False,
+            response_format={"type": "json_object"},  # type: ignore[call-overload]
+            max_tokens=16,
+            temperature=0,
+        )
 
     collected_response: str = ""
     if isinstance(response, openai.types.chat.ChatCompletion):
         completion_choices: list[openai.types.chat.chat_completion.Choice] = response.choices
         if completion_choices:
-            completion_message: openai.types.chat.chat_completion_message.ChatCompletionMessage = completion_choices[0].message
-            completion_content: str | None = completion_message.content
+            completion_content: str | None = completion_choices[0].message.content
             if completion_content is not None:
                 collected_response = completion_content
-    else:
-        for chunk in response:
-            if not chunk:
-                break
-            chunk_choices: list[openai.types.chat.chat_completion_chunk.Choice] = chunk.choices
-            if chunk_choices:
-                chunk_content: str | None = chunk_choices[0].delta.content
-                if chunk_content is not None:
-                    collected_response += chunk_content
 
     try:
-        json_response: dict = json.loads(collected_response.strip())
+        json_response: dict = orjson.loads(collected_response)
         if json_response.get("match", False):
             return filepath
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return Error(f"Failed to decode JSON from LLM for file \"{filepath}\"")
 
     return None
 
+async def process_files(filepaths: list[str], client: openai.AsyncOpenAI, system_message: str, args: argparse.Namespace) -> None:
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(args.jobs)
+
+    # Print results in the order they finish, not the order they were read in
+    for task in asyncio.as_completed([process_file(filepath, client, semaphore, system_message, args) for filepath in filepaths]):
+        result: str | Error | None = await task
+        if isinstance(result, Error):
+            print(result.message, file=sys.stderr)
+        elif result:
+            print(result)
+
 def main() -> int:
     args: argparse.Namespace = parse_args()
 
+    import httpx
+    import openai
+
     # Read from environment variables if not provided via command-line arguments
     api_key: str = args.api_key or os.getenv("OPENAI_API_KEY") or "dummy"
     base_url: str | None = args.base_url or os.getenv("OPENAI_BASE_URL")
@@ -129,9 +146,16 @@ def main() -> int:
     if not base_url:
         raise ValueError("Missing OpenAI API base URL")
 
-    client: openai.OpenAI = openai.OpenAI(
+    # Keep one connection alive per concurrent job so they get reused from file to file
+    http_client: httpx.AsyncClient = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=args.jobs, max_keepalive_connections=args.jobs, keepalive_expiry=60),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    )
+
+    client: openai.AsyncOpenAI = openai.AsyncOpenAI(
         api_key=api_key,
         base_url=base_url,
+        http_client=http_client,
     )
 
     system_message_parts: list[str] = [
@@ -145,16 +169,15 @@ def main() -> int:
 
     system_message: str = "\n".join(system_message_parts)
 
+    filepaths: list[str] = []
     while True:
         filepath: str = sys.stdin.readline().strip()
         if not filepath:
             break
 
-        result: str | Error | None = process_file(filepath, client, system_message, args)
-        if isinstance(result, Error):
-            print(result.message, file=sys.stderr)
-        elif result:
-            print(result)
+        filepaths.append(filepath)
+
+    asyncio.run(process_files(filepaths, client, system_message, args))
 
     return 0
 
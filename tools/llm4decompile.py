@@ -16,40 +16,106 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 
+from __future__ import annotations
+
 import argparse
 import os
 import subprocess
 import sys
-
-import requests  # type: ignore
-
-
-def format_with_clang_format(code: str, style: str = "") -> str:
-    """Format the given code using clang-format."""
-    try:
-        command: list[str] = ["clang-format"]
-        if style:
-            command.extend(["--style", style])
-        result: subprocess.CompletedProcess = subprocess.run(
-            command,
-            input=code,
-            capture_output=True,
-            check=True,
-            text=True,
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
+from typing import TYPE_CHECKING
+
+import orjson
+
+from support import llm_cache
+
+if TYPE_CHECKING:
+    import requests  # type: ignore
+
+
+def create_session() -> requests.Session:
+    """Create a keep-alive HTTP session that retries when the server is briefly unavailable."""
+    import requests  # type: ignore
+    from requests.adapters import HTTPAdapter, Retry  # type: ignore
+
+    retry: Retry = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET", "POST"])
+    adapter: HTTPAdapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session: requests.Session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def start_clang_format(style: str = "") -> subprocess.Popen:
+    """Start clang-format ahead of time so its startup overlaps with generation."""
+    command: list[str] = ["clang-format"]
+    if style:
+        command.extend(["--style", style])
+    return subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+def format_with_clang_format(code: str, formatter: subprocess.Popen) -> str:
+    """Format the given code using a clang-format process from start_clang_format()."""
+    stdout, _ = formatter.communicate(code)
+    if formatter.returncode != 0:
+        e: subprocess.CalledProcessError = subprocess.CalledProcessError(formatter.returncode, formatter.args)
         print("Error running clang-format: {}".format(e), file=sys.stderr)
         return code  # Return the original code if formatting fails
+    return stdout
+
+def read_generation(response: requests.Response, raw: bool) -> tuple[str, str | None]:
+    """Collect the generated code and the reason it stopped from a streaming Ollama response. The code is "" if generation failed."""
+    # Raw output doesn't need to wait for clang-format, so print it as it's generated. Whitespace
+    # is held back until more code follows it so the result matches the stripped, formatted output.
+    collected_chunks: list[str] = []
+    pending_whitespace: str = ""
+    printed_any: bool = False
+    for line in response.iter_lines():
+        if not line:
+            continue
+
+        chunk: dict = orjson.loads(line)
+
+        # Errors after the response has started arrive as a line in the stream, not as an HTTP status
+        if "error" in chunk:
+            if printed_any:
+                print()
+            print("Error from Ollama: {}".format(chunk["error"]), file=sys.stderr)
+            return "", None
+
+        chunk_content: str = chunk.get("response", "")
+        collected_chunks.append(chunk_content)
+
+        if raw:
+            text: str = pending_whitespace + chunk_content
+            printable: str = text.rstrip()
+            pending_whitespace = text[len(printable):]
+            if not printed_any:
+                printable = printable.lstrip()
+            if printable:
+                sys.stdout.write(printable)
+                sys.stdout.flush()
+                printed_any = True
+
+        if chunk.get("done"):
+            return "".join(collected_chunks).strip(), chunk.get("done_reason")
+
+    if printed_any:
+        print()
+    print("Error: Ollama's response ended before the generation was done.", file=sys.stderr)
+    return "", None
 
 def main() -> int:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Use an LLM to enhance code decompiled by Ghidra.")
     parser.add_argument("-r", "--raw", action="store_true", default=False, help="Print the output without formatting")
     parser.add_argument("--style", type=str, default="", help="Specify a style for clang-format")
+    parser.add_argument("--no-cache", action="store_true", default=False, help="Always query the LLM, ignoring and not updating the response cache")
+    parser.add_argument("--warmup", action="store_true", default=False, help="Load the model into memory and exit without reading stdin (e.g., at the start of a pipeline)")
     args: argparse.Namespace = parser.parse_args()
 
-    input_data: str = sys.stdin.read().strip()
-
     payload = {
         "model": "llm4decompile:22b-v2-q6_K",
         "options": {
@@ -59,8 +125,8 @@ def main() -> int:
         #"options": {
         #    "num_ctx": 128*1024,
         #},
-        "stream": False,
-        "prompt": input_data,
+        "stream": True,
+        "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
     }
 
     ollama_host: str = os.getenv("OLLAMA_HOST", "localhost:11434")
@@ -68,18 +134,64 @@ def main() -> int:
         ollama_host = "http://" + ollama_host
     url: str = "{}/api/generate".format(ollama_host)
 
-    response: requests.Response = requests.post(url, json=payload)
-    response.raise_for_status()
-
-    llm_code: str = response.json()["response"].strip()
+    if args.warmup:
+        # An empty prompt only loads the model. The options are sent too, since a different context
+        # size would make Ollama reload the model on the next real request.
+        warmup_response: requests.Response = create_session().post(
+            url,
+            data=orjson.dumps({**payload, "prompt": "", "stream": False}),
+            headers={"Content-Type": "application/json"},
+        )
+        warmup_response.raise_for_status()
+        return 0
+
+    input_data: str = sys.stdin.buffer.read().decode("utf-8", "replace").strip()
+    payload["prompt"] = input_data
+
+    cache_key: str = llm_cache.make_key(
+        payload["model"],  # type: ignore[arg-type]
+        orjson.dumps(payload["options"], option=orjson.OPT_SORT_KEYS).decode("utf-8"),
+        input_data,
+    )
+    cached_code: str | None = None if args.no_cache else llm_cache.load(cache_key)
+
+    formatter: subprocess.Popen | None = None
+    llm_code: str
+    if cached_code is not None:
+        llm_code = cached_code
+        if args.raw:
+            print(llm_code, end="")
+        else:
+            formatter = start_clang_format(style=args.style)
+    else:
+        session: requests.Session = create_session()
+
+        response: requests.Response = session.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, stream=True)
+        response.raise_for_status()
+
+        if not args.raw:
+            formatter = start_clang_format(style=args.style)
+
+        done_reason: str | None
+        llm_code, done_reason = read_generation(response, args.raw)
+
+        # Don't cache generations that were cut short, e.g. by the token limit
+        if llm_code and done_reason == "stop" and not args.no_cache:
+            llm_cache.store(cache_key, llm_code)
 
     if not llm_code:
+        if formatter is not None:
+            formatter.kill()
+            formatter.wait()
         print("Error: LLM failed to enhance code.", file=sys.stderr)
         return 1
 
-    if not args.raw:
-        # Format the output using clang-format
-        llm_code = format_with_clang_format(llm_code, style=args.style).strip()
+    if args.raw or formatter is None:
+        print()
+        return 0
+
+    # Format the output using clang-format
+    llm_code = format_with_clang_format(llm_code, formatter).strip()
 
     print(llm_code)
 
@@ -15,16 +15,16 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 
-import random
-import string
+import secrets
 
 import panflute as pf  # type: ignore[import-not-found]
 
 
 def action(elem: pf.Element, doc: pf.Doc) -> pf.Element | list[pf.Element] | None:
-    if isinstance(elem, pf.CodeBlock):
+    # Nothing subclasses CodeBlock, so an exact type check is enough
+    if type(elem) is pf.CodeBlock:
         # Generate a random ID for the code block
-        code_tag: str = "_" + "".join(random.choice(string.ascii_letters + string.digits) for i in range(12))
+        code_tag: str = "_" + secrets.token_urlsafe(9)
         elem.identifier = code_tag
 
         # Extract the language and filename from the Markdown code block identifier
@@ -0,0 +1,72 @@
+# SPDX-License-Identifier: 0BSD
+
+# Copyright (C) 2026 by Forest Crossman <cyrozap@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+# PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+
+CACHE_DIR: Path = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "misc-llm"
+
+MAX_AGE: int = 30 * 24 * 60 * 60
+
+# Set once store() has swept out expired entries, so a batch of stores only scans the directory once
+swept: bool = False
+
+
+def make_key(*parts: str) -> str:
+    """Hash everything that affects a response (model, options, prompt, etc.) into a cache key."""
+    return hashlib.blake2b("\x00".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+def load(key: str) -> str | None:
+    """Return the cached response for the key, or None if there isn't a fresh one."""
+    path: Path = CACHE_DIR / key
+    try:
+        if time.time() - path.stat().st_mtime > MAX_AGE:
+            # Remove the stale entry now instead of waiting for the next sweep in store()
+            path.unlink(missing_ok=True)
+            return None
+        return path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+def remove_expired() -> None:
+    """Delete every entry that is too old to be loaded, including ones that will never be requested again."""
+    now: float = time.time()
+    for path in CACHE_DIR.iterdir():
+        try:
+            if now - path.stat().st_mtime > MAX_AGE:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+def store(key: str, response: str) -> None:
+    """Save a response under the key."""
+    global swept
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    if not swept:
+        remove_expired()
+        swept = True
+
+    # Write to a temporary file first so concurrent readers never see a partial response
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".tmp-")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(response)
+    os.replace(tmp_path, CACHE_DIR / key)
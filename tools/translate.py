@@ -16,50 +16,156 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 
+from __future__ import annotations
+
 import argparse
+import asyncio
+import json
 import os
 import sys
 import time
 from enum import Enum
+from typing import TYPE_CHECKING
+
+from support import llm_cache
 
-import openai
+if TYPE_CHECKING:
+    import openai
 
 
 MODELS: list[str] = [
     "qwen3:30b-a3b-instruct-2507-q4_K_M-200k",
 ]
 
+# Maps every prefix of every model name to the first model in MODELS that it matches
+MODELS_BY_PREFIX: dict[str, str] = {model[:i]: model for model in reversed(MODELS) for i in range(len(model) + 1)}
+
+# Used by both parse_args() and default_args(), so running without arguments gets the same settings
+DEFAULT_ARGS: dict[str, object] = {
+    "api_key": None,
+    "base_url": None,
+    "model": MODELS[0],
+    "language": "English",
+    "no_cache": False,
+    "batch": False,
+    "concurrency": 4,
+}
+
+THINK_OPEN: str = "<think>"
+THINK_CLOSE: str = "</think>"
+
+
+class CoalescingPrinter:
+    """Collects streamed text and writes it to stdout in batches instead of once per token."""
+
+    def __init__(self, max_delay: float = 0.016, max_size: int = 256) -> None:
+        self.max_delay: float = max_delay
+        self.max_size: int = max_size
+        self.pending: bytearray = bytearray()
+        self.last_flush: float = time.monotonic()
+        self.write = sys.stdout.buffer.write
+        self.flush_stdout = sys.stdout.buffer.flush
+
+    def print(self, text: str) -> None:
+        self.pending += text.encode("utf-8")
+        # Flush completed lines right away for anything reading the output line by line
+        if "\n" in text or len(self.pending) >= self.max_size or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        self.write(self.pending)
+        self.flush_stdout()
+        self.pending.clear()
+        self.last_flush = time.monotonic()
+
 
 class ThinkingState(Enum):
     PRE_THINKING = 0
     THINKING = 1
-    END_THINKING = 2
-    DONE_THINKING = 3
+    DONE_THINKING = 2
+
+
+class ThinkTracker:
+    """Strips the <think> block out of streamed text, even when its tags are split across chunks."""
+
+    def __init__(self) -> None:
+        self.state: ThinkingState = ThinkingState.PRE_THINKING
+        self.held: str = ""
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of the chunk that isn't thinking and is safe to print now."""
+        if self.state is ThinkingState.DONE_THINKING:
+            return chunk
+
+        text: str = self.held + chunk
+        self.held = ""
+        visible: list[str] = []
+        while self.state is not ThinkingState.DONE_THINKING:
+            tag: str = THINK_OPEN if self.state is ThinkingState.PRE_THINKING else THINK_CLOSE
+            idx: int = text.find(tag)
+            if idx < 0:
+                # Hold back anything at the end that could be the start of a tag
+                held_len: int = next((n for n in range(min(len(tag) - 1, len(text)), 0, -1) if text.endswith(tag[:n])), 0)
+                self.held = text[len(text) - held_len:]
+                text = text[:len(text) - held_len]
+                break
+
+            if self.state is ThinkingState.PRE_THINKING:
+                visible.append(text[:idx])
+                self.state = ThinkingState.THINKING
+            else:
+                self.state = ThinkingState.DONE_THINKING
+            text = text[idx + len(tag):]
+
+        if self.state is not ThinkingState.THINKING:
+            visible.append(text)
+
+        return "".join(visible)
+
+    def flush(self) -> str:
+        """Return any text still being held back once the stream has ended."""
+        held: str = self.held
+        self.held = ""
+        return "" if self.state is ThinkingState.THINKING else held
 
 
 def find_model_by_prefix(prefix: str) -> str:
-    for model in MODELS:
-        if model.startswith(prefix):
-            return model
+    model: str | None = MODELS_BY_PREFIX.get(prefix)
+    if model is not None:
+        return model
     raise ValueError(f"Model with prefix \"{prefix}\" not found. Available models are: {", ".join(MODELS)}")
 
+def positive_int(value: str) -> int:
+    number: int = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def parse_args() -> argparse.Namespace:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Translate text to a specified language.", formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("-k", "--api-key", type=str,
                         help="Your OpenAI API key (can also be set via the OPENAI_API_KEY environment variable)")
     parser.add_argument("-b", "--base-url", type=str,
                         help="Your OpenAI API base URL (can also be set via the OPENAI_BASE_URL environment variable)")
-    parser.add_argument("-m", "--model", type=find_model_by_prefix, default=MODELS[0],
+    parser.add_argument("-m", "--model", type=find_model_by_prefix,
                         help="Model to use. You can provide a prefix match for any of the following models (default: {}):\n\n{} ".format(
-                            MODELS[0], "\n".join(["- {}".format(model) for model in MODELS])))
-    parser.add_argument("-l", "--language", type=str, default="English",
-                        help="Language to translate text into (default: English)")
+                            DEFAULT_ARGS["model"], "\n".join(["- {}".format(model) for model in MODELS])))
+    parser.add_argument("-l", "--language", type=str,
+                        help="Language to translate text into (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always query the LLM, ignoring and not updating the response cache")
+    parser.add_argument("--batch", action="store_true",
+                        help="Read one JSON string per line from stdin and write each translation as a JSON string on its own line, in the same order")
+    parser.add_argument("-j", "--concurrency", type=positive_int,
+                        help="Number of translations to run at once in batch mode (default: %(default)s)")
+    parser.set_defaults(**DEFAULT_ARGS)
 
     return parser.parse_args()
 
-def main() -> int:
-    args: argparse.Namespace = parse_args()
+def default_args() -> argparse.Namespace:
+    return argparse.Namespace(**DEFAULT_ARGS)
 
+def get_api_settings(args: argparse.Namespace) -> tuple[str, str]:
     # Read from environment variables if not provided via command-line arguments
     api_key: str = args.api_key or os.getenv("OPENAI_API_KEY") or "dummy"
     base_url: str | None = args.base_url or os.getenv("OPENAI_BASE_URL")
@@ -67,30 +173,130 @@ def main() -> int:
     if not base_url:
         raise ValueError("Missing OpenAI API base URL")
 
-    client: openai.OpenAI = openai.OpenAI(
+    return api_key, base_url
+
+async def translate_one(input_data: str, client: openai.AsyncOpenAI, semaphore: asyncio.Semaphore, system_prompt: dict[str, str], args: argparse.Namespace) -> str:
+    import openai
+
+    cache_key: str = llm_cache.make_key(args.model, system_prompt["content"], input_data)
+    if not args.no_cache:
+        cached_translation: str | None = llm_cache.load(cache_key)
+        if cached_translation is not None:
+            # Entries stored by single translations before they were stripped may still have surrounding whitespace
+            return cached_translation.strip()
+
+    messages: tuple[dict[str, str], ...] = (
+        system_prompt,
+        {
+            "role": "user",
+            "content": input_data,
+        },
+    )
+
+    async with semaphore:
+        response: openai.types.chat.ChatCompletion | openai.AsyncStream[openai.types.chat.ChatCompletionChunk] = await client.chat.completions.create(
+            model=args.model,
+            messages=messages,  # type: ignore[arg-type]
+            stream=False,
+        )
+
+    content: str = ""
+    finish_reason: str | None = None
+    if isinstance(response, openai.types.chat.ChatCompletion) and response.choices:
+        content = response.choices[0].message.content or ""
+        finish_reason = response.choices[0].finish_reason
+
+    tracker: ThinkTracker = ThinkTracker()
+    translation: str = (tracker.feed(content) + tracker.flush()).strip()
+
+    # Don't cache translations that were cut short, e.g. by the token limit
+    if translation and finish_reason == "stop" and not args.no_cache:
+        llm_cache.store(cache_key, translation)
+
+    return translation
+
+async def translate_batch(system_prompt: dict[str, str], args: argparse.Namespace) -> int:
+    import httpx
+    import openai
+
+    api_key, base_url = get_api_settings(args)
+
+    # Every request in the batch shares this client. Over HTTPS, HTTP/2 lets them all share one connection.
+    http_client: httpx.AsyncClient = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    )
+
+    client: openai.AsyncOpenAI = openai.AsyncOpenAI(
         api_key=api_key,
         base_url=base_url,
+        http_client=http_client,
     )
 
-    input_data: str = sys.stdin.read().strip()
+    inputs: list[str] = []
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        item: object = json.loads(line)
+        if not isinstance(item, str):
+            raise ValueError(f"Expected a JSON string on each line, got: {line.decode('utf-8', 'replace').strip()}")
+        inputs.append(item.strip())
+
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(args.concurrency)
+    tasks: list[asyncio.Task[str]] = [asyncio.create_task(translate_one(input_data, client, semaphore, system_prompt, args)) for input_data in inputs]
+
+    # Print each result as soon as it and everything before it is done, so output stays in input order
+    for task in tasks:
+        print(json.dumps(await task, ensure_ascii=False), flush=True)
+
+    return 0
+
+def main() -> int:
+    # Skip building the parser when there's nothing for it to parse
+    args: argparse.Namespace = default_args() if len(sys.argv) == 1 else parse_args()
 
     system_message: str = f"Translate the provided text to {args.language}. YOU MUST ONLY OUTPUT THE TRANSLATED TEXT!"
 
     if args.model.startswith("qwen3:") and not args.model.startswith("qwen3:30b-a3b-instruct-2507"):
         system_message += " /no_think"
 
-    messages: list[dict[str, str]] = [
-        {
-            "role": "system",
-            "content": system_message,
-        },
+    # Only the user message changes from one request to the next, so every request reuses this one
+    system_prompt: dict[str, str] = {
+        "role": "system",
+        "content": system_message,
+    }
+
+    if args.batch:
+        return asyncio.run(translate_batch(system_prompt, args))
+
+    input_data: str = sys.stdin.buffer.read().decode("utf-8", "replace").strip()
+
+    cache_key: str = llm_cache.make_key(args.model, system_message, input_data)
+    if not args.no_cache:
+        cached_translation: str | None = llm_cache.load(cache_key)
+        if cached_translation is not None:
+            print(cached_translation)
+            return 0
+
+    import openai
+
+    api_key, base_url = get_api_settings(args)
+
+    client: openai.OpenAI = openai.OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+    )
+
+    messages: tuple[dict[str, str], ...] = (
+        system_prompt,
         {
             "role": "user",
             "content": input_data,
         },
-    ]
+    )
 
-    start_time: float = time.time()
+    start_time: int = time.monotonic_ns()
 
     response: openai.Stream[openai.types.chat.ChatCompletionChunk] = client.chat.completions.create(
         model=args.model,
@@ -99,63 +305,86 @@ def main() -> int:
         stream_options={"include_usage": True},  # type: ignore[call-overload]
     )
 
-    response_start: float | None = None
-    think_start: float | None = None
-    think_end: float | None = None
+    response_start: int | None = None
+    think_start: int | None = None
+    think_end: int | None = None
+
+    tracker: ThinkTracker = ThinkTracker()
 
-    thinking_state: ThinkingState = ThinkingState.PRE_THINKING
+    printer: CoalescingPrinter = CoalescingPrinter()
+    translation_chunks: list[str] = []
 
     usage: openai.types.chat.chat_completion.CompletionUsage | None = None
+    finish_reason: str | None = None
     for chunk in response:
         if not chunk:
             break
-        if thinking_state == ThinkingState.END_THINKING:
-            thinking_state = ThinkingState.DONE_THINKING
         usage = chunk.usage
         choices: list[openai.types.chat.chat_completion_chunk.Choice] = chunk.choices
         if choices:
+            if choices[0].finish_reason is not None:
+                finish_reason = choices[0].finish_reason
             chunk_content: str | None = choices[0].delta.content
             if chunk_content is not None:
                 if response_start is None:
-                    response_start = time.time()
+                    response_start = time.monotonic_ns()
 
-                if "<think>" in chunk_content and think_start is None:
-                    think_start = time.time()
-                    if thinking_state == ThinkingState.PRE_THINKING:
-                        thinking_state = ThinkingState.THINKING
+                visible: str = tracker.feed(chunk_content)
 
-                if "</think>" in chunk_content and think_end is None:
-                    think_end = time.time()
-                    if thinking_state == ThinkingState.THINKING:
-                        thinking_state = ThinkingState.END_THINKING
+                if think_end is None and tracker.state is not ThinkingState.PRE_THINKING:
+                    if think_start is None:
+                        think_start = time.monotonic_ns()
+                    if tracker.state is ThinkingState.DONE_THINKING:
+                        think_end = time.monotonic_ns()
 
-                if thinking_state in (ThinkingState.PRE_THINKING, ThinkingState.DONE_THINKING):
-                    print(chunk_content, end="", flush=True)
+                if visible:
+                    printer.print(visible)
+                    translation_chunks.append(visible)
+
+    remaining: str = tracker.flush()
+    if remaining:
+        printer.print(remaining)
+        translation_chunks.append(remaining)
+    printer.flush()
     print()
 
-    end_time: float = time.time()
+    end_time: int = time.monotonic_ns()
+
+    # Stored stripped, the same as batch mode, so a cached result doesn't depend on which mode produced it
+    translation: str = "".join(translation_chunks).strip()
+    # Don't cache translations that were cut short, e.g. by the token limit
+    if translation and finish_reason == "stop" and not args.no_cache:
+        llm_cache.store(cache_key, translation)
 
     if response_start is None:
         response_start = end_time
 
     thinking_time: float = 0
     if think_start is not None and think_end is not None:
-        thinking_time = think_end - think_start
+        thinking_time = (think_end - think_start) / 1e9
 
     if usage:
-        pp_time: float = response_start - start_time
-        gen_time: float = end_time - response_start
-        total_time: float = end_time - start_time
+        pp_time: float = (response_start - start_time) / 1e9
+        gen_time: float = (end_time - response_start) / 1e9
+        total_time: float = (end_time - start_time) / 1e9
+
+        total_tokens: int = usage.total_tokens
+        prompt_tokens: int = usage.prompt_tokens
+        completion_tokens: int = usage.completion_tokens
+
+        # Either phase can take no measurable time, e.g. when the prompt is served from the cache
+        pp_speed: float = prompt_tokens / pp_time if pp_time > 1e-6 else 0.0
+        gen_speed: float = completion_tokens / gen_time if gen_time > 1e-6 else 0.0
 
         token_usage_message: str = "\n".join([
             "",
-            "Tokens used: {}".format(usage.total_tokens),  # type: ignore[union-attr]
-            "Prompt tokens: {}".format(usage.prompt_tokens),  # type: ignore[union-attr]
-            "Completion tokens: {}".format(usage.completion_tokens),  # type: ignore[union-attr]
-            "Total time taken: {:.6f} seconds".format(total_time),
-            "Time spent thinking: {:.6f} seconds".format(thinking_time),
-            "Prompt processing speed: {:.2f} tokens/s".format(usage.prompt_tokens / pp_time),  # type: ignore[union-attr]
-            "Generation speed: {:.2f} tokens/s".format(usage.completion_tokens / gen_time),  # type: ignore[union-attr]
+            f"Tokens used: {total_tokens}",
+            f"Prompt tokens: {prompt_tokens}",
+            f"Completion tokens: {completion_tokens}",
+            f"Total time taken: {total_time:.6f} seconds",
+            f"Time spent thinking: {thinking_time:.6f} seconds",
+            f"Prompt processing speed: {pp_speed:.2f} tokens/s",
+            f"Generation speed: {gen_speed:.2f} tokens/s",
         ])
 
         print(token_usage_message, file=sys.stderr)